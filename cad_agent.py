@@ -17,17 +17,35 @@ Supported Primitives:
     - torus: { "type": "torus", "radius": float, "tube": float, "position": [x,y,z], "rotation": [rx,ry,rz] }
 
 Features (applied to primitives):
-    - fillet: { "type": "fillet", "target": "feature_id", "radius": float, "edges": ["edge_id", ...] }
-    - chamfer: { "type": "chamfer", "target": "feature_id", "distance": float, "edges": ["edge_id", ...] }
-    - extrude: { "type": "extrude", "sketch": "sketch_id", "distance": float, "direction": [x,y,z] }
+    - fillet: { "type": "fillet", "target": "feature_id", "radius": float }
+    - chamfer: { "type": "chamfer", "target": "feature_id", "distance": float }
 """
 
 import os
+import re
+import sys
 import json
 import uuid
+import atexit
+import asyncio
+import threading
+import operator
+import functools
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterator
+import orjson
+import xxhash
+import fastjsonschema
 from dotenv import load_dotenv
-from xai_sdk import Client
-from xai_sdk.chat import user, system
+from xai_sdk import AsyncClient
+from xai_sdk.chat import user, system, assistant
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # Paraphrase matching is optional; exact-match caching always works
+    np = None
+    SentenceTransformer = None
 
 load_dotenv()
 
@@ -102,6 +120,392 @@ Output:
 AT feat_001 REPLACE {"type": "cube", "width": 150, "height": 5, "depth": 60, "position": [0, 50, 0], "rotation": [0, 0, 0]}
 """
 
+# Matches one patch line: AT <feature_id> <ACTION> [<JSON_content>]
+_PATCH_RE = re.compile(r'AT (\S+) (INSERT|REPLACE|DELETE)(?: (.*))?$')
+
+
+def _schema(type_name: str, sizes: tuple = (), vectors: tuple = (), refs: tuple = ()) -> dict:
+    """Build the JSON Schema for one primitive or feature type; every listed field is required."""
+    properties = {"type": {"const": type_name}}
+    properties.update({key: {"type": "number", "exclusiveMinimum": 0} for key in sizes})
+    properties.update({key: {"type": "array", "items": {"type": "number"}, "minItems": 3, "maxItems": 3}
+                       for key in vectors})
+    properties.update({key: {"type": "string"} for key in refs})
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+# Fields of every primitive and feature type the model may emit, by kind
+_TYPE_FIELDS = {
+    "cube": {"sizes": ("width", "height", "depth"), "vectors": ("position", "rotation")},
+    "cylinder": {"sizes": ("radius", "height"), "vectors": ("position", "rotation")},
+    "sphere": {"sizes": ("radius",), "vectors": ("position",)},
+    "cone": {"sizes": ("radius", "height"), "vectors": ("position", "rotation")},
+    "torus": {"sizes": ("radius", "tube"), "vectors": ("position", "rotation")},
+    "fillet": {"sizes": ("radius",), "refs": ("target",)},
+    "chamfer": {"sizes": ("distance",), "refs": ("target",)},
+}
+
+# Compiled once at import; each validator raises JsonSchemaException on bad data
+_VALIDATORS = {name: fastjsonschema.compile(_schema(name, **fields)) for name, fields in _TYPE_FIELDS.items()}
+
+
+def _validate_patch(patch: dict) -> bool:
+    """Check a patch's data against its type's schema, warning about and rejecting bad ones."""
+    if patch['action'] == 'DELETE':
+        return True
+
+    data = patch['data']
+    type_name = data.get('type') if isinstance(data, dict) else None
+    validator = _VALIDATORS.get(type_name) if isinstance(type_name, str) else None
+    if validator is None:
+        print(f"Warning: Dropping patch for {patch['feature_id']} with unknown type: {data}")
+        return False
+    try:
+        validator(data)
+    except fastjsonschema.JsonSchemaException as e:
+        print(f"Warning: Dropping invalid patch for {patch['feature_id']}: {e.message}")
+        return False
+    return True
+
+
+# Conversation history is compacted once it grows past this many messages,
+# keeping the system prompt plus the most recent turns.
+MAX_HISTORY_MESSAGES = 60
+HISTORY_KEEP_TURNS = 4
+
+# Responses are reused for paraphrased requests whose embedding is at least
+# this similar to a cached one made against the same design state.
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# Where the CLI keeps its input history between runs
+HISTORY_FILE = os.path.expanduser("~/.cad_agent_history")
+
+
+class Feature:
+    """
+    Compact record for one feature in the design.
+
+    Each type gets a subclass (see _FEATURE_CLASSES) with one slot per scalar
+    schema field, vectors split into <name>_x/_y/_z slots, so a feature is one
+    small object rather than a dict plus two lists. Keys outside the schema
+    are kept in `extra` so to_dict() returns everything the model sent.
+    """
+
+    __slots__ = ('extra', 'hash')
+
+    TYPE = None
+    FIELDS = ()  # Schema field names
+    VECTORS = {}  # {vector field: its three slot names}
+    REFS = ()  # String fields
+    LINE_FORMAT = None  # %-format of the snapshot line, keys in sorted order
+    LINE_SLOTS = None  # attrgetter returning the slot values LINE_FORMAT takes, in order
+
+    def __init__(self, feature_id: str, data: dict):
+        vectors = self.VECTORS
+        for key in self.FIELDS:
+            value = data[key]
+            if key in vectors:
+                for slot, component in zip(vectors[key], value):
+                    setattr(self, slot, component)
+            else:
+                setattr(self, key, value)
+        self.extra = {k: v for k, v in data.items() if k != 'type' and k not in self.FIELDS} or None
+        self.hash = xxhash.xxh3_64_intdigest(orjson.dumps(
+            (feature_id, self.TYPE, self.LINE_SLOTS(self), self.extra), option=orjson.OPT_SORT_KEYS
+        ))
+
+    def to_dict(self) -> dict:
+        """Rebuild the feature's JSON object."""
+        data = {'type': self.TYPE}
+        for key in self.FIELDS:
+            slots = self.VECTORS.get(key)
+            data[key] = [getattr(self, slot) for slot in slots] if slots else getattr(self, key)
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def line(self, feature_id: str) -> str:
+        """Render the feature's snapshot line from its slots, with keys sorted so it is deterministic."""
+        if self.extra:
+            # Unknown keys can hold anything, so let orjson sort and encode them
+            return f"- {feature_id}: {orjson.dumps(self.to_dict(), option=orjson.OPT_SORT_KEYS).decode()}\n"
+        values = self.LINE_SLOTS(self)
+        if self.REFS:
+            # Strings may contain commas, so encode each value on its own
+            encoded = [orjson.dumps(value).decode() for value in values]
+        else:
+            # Numbers never contain commas, so one dumps() encodes them all
+            encoded = orjson.dumps(values).decode()[1:-1].split(',')
+        return self.LINE_FORMAT % (feature_id, *encoded)
+
+
+def _feature_class(type_name: str, sizes: tuple = (), vectors: tuple = (), refs: tuple = ()) -> type:
+    """Create the Feature subclass whose slots hold exactly this type's fields."""
+    fields = refs + sizes + vectors
+    vector_slots = {key: (f"{key}_x", f"{key}_y", f"{key}_z") for key in vectors}
+
+    parts, line_slots = [], []
+    for key in sorted(fields + ('type',)):
+        if key == 'type':
+            parts.append(f'"type":"{type_name}"')
+        elif key in vector_slots:
+            parts.append(f'"{key}":[%s,%s,%s]')
+            line_slots.extend(vector_slots[key])
+        else:
+            parts.append(f'"{key}":%s')
+            line_slots.append(key)
+
+    return type(type_name.capitalize(), (Feature,), {
+        '__slots__': refs + sizes + tuple(slot for key in vectors for slot in vector_slots[key]),
+        'TYPE': type_name,
+        'FIELDS': fields,
+        'VECTORS': vector_slots,
+        'REFS': refs,
+        'LINE_FORMAT': "- %s: {" + ",".join(parts) + "}\n",
+        'LINE_SLOTS': operator.attrgetter(*line_slots),
+    })
+
+
+_FEATURE_CLASSES = {name: _feature_class(name, **fields) for name, fields in _TYPE_FIELDS.items()}
+
+
+class PatchStreamParser:
+    """
+    Incrementally parse streamed "AT <feature_id> <ACTION> <JSON>" lines.
+
+    Each chunk is scanned once as it arrives. A patch is emitted as soon as
+    its line ends after the JSON body closes, without re-scanning earlier
+    text. As in _parse_patches, a line with anything but whitespace after
+    the JSON object is rejected. Consumed text is dropped on every feed, so
+    the buffer never holds more than the patch being parsed.
+    """
+
+    EXPECT_AT, FEATURE_ID, ACTION, JSON_BODY, AFTER_BODY = range(5)
+
+    def __init__(self):
+        self.state = self.EXPECT_AT
+        self.brace_depth = 0
+        self.in_string = False
+        self.escape = False
+        self._buf = ""
+        self._pos = 0  # Next offset in _buf to scan
+        self._start = 0  # Offset where the current token began
+        self._skip_line = False  # Discarding the rest of a non-patch line
+        self._body_len = 0  # Length of the closed JSON body, from _start
+        self._feature_id = None
+        self._action = None
+
+    def feed(self, chunk: str) -> Iterator[dict]:
+        """Consume a chunk of streamed text, yielding every patch it completes."""
+        buf = self._buf = self._buf[self._start:] + chunk
+        pos = self._pos - self._start
+        start = 0
+        end = len(buf)
+
+        while pos < end:
+            if self._skip_line:
+                newline = buf.find('\n', pos)
+                if newline < 0:
+                    pos = start = end
+                    break
+                pos = start = newline + 1
+                self._skip_line = False
+
+            elif self.state == self.EXPECT_AT:
+                while pos < end and buf[pos] in ' \t\r\n':
+                    pos += 1
+                start = pos
+                if end - pos < 3:
+                    # Not enough text yet to tell whether this line is a patch
+                    if not "AT ".startswith(buf[pos:end]):
+                        self._skip_line = True
+                    break
+                if buf.startswith("AT ", pos):
+                    pos = start = pos + 3
+                    self.state = self.FEATURE_ID
+                else:
+                    self._skip_line = True
+
+            elif self.state in (self.FEATURE_ID, self.ACTION):
+                space = buf.find(' ', pos)
+                newline = buf.find('\n', pos)
+                if space < 0 and newline < 0:
+                    pos = end
+                    break
+
+                if self.state == self.FEATURE_ID:
+                    if 0 <= newline < space or space < 0:
+                        self._reset_line(skip=False)
+                        pos = start = newline + 1
+                        continue
+                    self._feature_id = sys.intern(buf[start:space])
+                    pos = start = space + 1
+                    self.state = self.ACTION
+                    continue
+
+                stop = newline if 0 <= newline < space or space < 0 else space
+                action = buf[start:stop].strip()
+                if action not in ('INSERT', 'REPLACE', 'DELETE'):
+                    self._reset_line(skip=stop == space)
+                    pos = start = stop + 1
+                    continue
+                self._action = action
+                pos = start = stop + 1
+                if stop == newline:
+                    # No JSON body on the line, e.g. "AT feat_003 DELETE"
+                    patch = self._emit('{}')
+                    if patch:
+                        yield patch
+                else:
+                    self.state = self.JSON_BODY
+
+            elif self.state == self.JSON_BODY:
+                while pos < end:
+                    c = buf[pos]
+                    if self.brace_depth == 0:
+                        if c == '{':
+                            self.brace_depth = 1
+                            start = pos
+                        elif c == '\n':
+                            patch = self._emit('{}')
+                            if patch:
+                                yield patch
+                            break
+                        elif c not in ' \t\r':
+                            self._reset_line(skip=True)
+                            break
+                    elif self.in_string:
+                        if self.escape:
+                            self.escape = False
+                        elif c == '\\':
+                            self.escape = True
+                        elif c == '"':
+                            self.in_string = False
+                    elif c == '"':
+                        self.in_string = True
+                    elif c == '{':
+                        self.brace_depth += 1
+                    elif c == '}':
+                        self.brace_depth -= 1
+                        if self.brace_depth == 0:
+                            # Emit once the rest of the line is known to be blank
+                            self._body_len = pos + 1 - start
+                            self.state = self.AFTER_BODY
+                            pos += 1
+                            break
+                    elif c == '\n':
+                        self._warn(buf[start:pos])
+                        self._reset_line(skip=False)
+                        break
+                    pos += 1
+                else:
+                    continue
+                if self.state != self.AFTER_BODY:
+                    pos = start = pos + 1
+
+            else:  # AFTER_BODY
+                while pos < end and buf[pos] in ' \t\r':
+                    pos += 1
+                if pos == end:
+                    break
+                if buf[pos] == '\n':
+                    patch = self._emit(buf[start:start + self._body_len])
+                    if patch:
+                        yield patch
+                    pos = start = pos + 1
+                else:
+                    newline = buf.find('\n', pos)
+                    line_end = newline if newline >= 0 else end
+                    self._warn(buf[start:line_end])
+                    self._reset_line(skip=newline < 0)
+                    pos = start = line_end + 1 if newline >= 0 else end
+
+        self._pos = pos
+        self._start = start
+
+    def close(self) -> Iterator[dict]:
+        """Flush a final patch whose line was not terminated by a newline."""
+        if self.state == self.ACTION:
+            # Feeding a newline terminates the pending action token
+            yield from self.feed('\n')
+        elif self.state == self.JSON_BODY and self.brace_depth == 0:
+            patch = self._emit('{}')
+            if patch:
+                yield patch
+        elif self.state == self.AFTER_BODY:
+            patch = self._emit(self._buf[self._start:self._start + self._body_len])
+            if patch:
+                yield patch
+        elif self.state == self.JSON_BODY:
+            self._warn(self._buf[self._start:])
+        self._reset_line(skip=False)
+        self._buf = ""
+        self._pos = self._start = 0
+
+    def _emit(self, json_str: str) -> dict | None:
+        """Build the patch for the current line and reset for the next one."""
+        patch = None
+        try:
+            patch = {
+                'feature_id': self._feature_id,
+                'action': self._action,
+                'data': orjson.loads(json_str)
+            }
+        except orjson.JSONDecodeError:
+            self._warn(json_str)
+        self._reset_line(skip=False)
+        return patch if patch and _validate_patch(patch) else None
+
+    def _warn(self, json_str: str):
+        """Report a patch line whose JSON body could not be parsed."""
+        print(f"Warning: Failed to parse patch line: AT {self._feature_id} {self._action} {json_str}")
+
+    def _reset_line(self, skip: bool):
+        """Return to looking for the next "AT " line."""
+        self.state = self.EXPECT_AT
+        self.brace_depth = 0
+        self.in_string = False
+        self.escape = False
+        self._skip_line = skip
+        self._body_len = 0
+        self._feature_id = None
+        self._action = None
+
+
+def _in_daemon_thread(func, *args) -> asyncio.Future:
+    """
+    Run func(*args) on a daemon thread and return a future for its result.
+
+    Used instead of asyncio.to_thread(), whose default-executor workers are
+    not daemon threads: asyncio.run() joins them on shutdown, so a pending
+    input() or a slow embedding-model load would delay exit after 'quit'.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result, error):
+        if future.done():  # Cancelled while the thread was running
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run():
+        result, error = None, None
+        try:
+            result = func(*args)
+        except BaseException as e:  # Includes KeyboardInterrupt from input()
+            error = e
+        try:
+            loop.call_soon_threadsafe(settle, result, error)
+        except RuntimeError:  # Event loop already closed
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
 
 class CADAgent:
     """Agent that converts natural language to CAD DSL patches."""
@@ -112,29 +516,206 @@ class CADAgent:
         if not api_key:
             raise ValueError("XAI_API_KEY environment variable is required")
 
-        self.client = Client(api_key=api_key, timeout=3600)
+        self.client = AsyncClient(api_key=api_key, timeout=3600)
         self.model = model
         self.chat = None
-        self.features = {}  # Track current features: {feature_id: json_data}
+        self.features = {}  # Track current features: {feature_id: Feature}
+        self._context_cache = None  # Last _state_snapshot() result
+        self._context_dirty = True  # Whether features changed since it was built
+        self._state_hash = 0  # XOR of every feature's hash, kept current by _apply_patches
         self.feature_counter = 0
+        self._turn_starts = []  # Index into chat.messages where each turn begins
+        self._exact_cache = {}  # {(state_hash, normalized_input): patches}
+        self._fuzzy_cache = {}  # {state_hash: (embedding_matrix, [patches, ...])}
+        self._embeddings = {}  # {normalized_input: unit-length embedding}
+        self._embedder = None
+        self._fuzzy_enabled = SentenceTransformer is not None  # Cleared if the model fails
+        self._embedder_lock = threading.Lock()
         self._init_chat()
 
     def _init_chat(self):
         """Initialize a new chat session with the system prompt."""
         self.chat = self.client.chat.create(model=self.model)
+        # The system prompt is always the first message and never rewritten,
+        # so the provider's automatic prefix cache can reuse its prefill.
         self.chat.append(system(CAD_SYSTEM_PROMPT))
 
-    def _get_context_prompt(self) -> str:
-        """Generate context about current features for the LLM."""
-        if not self.features:
-            return ""
+    def _state_snapshot(self) -> str:
+        """Describe every current feature, used when old history is evicted."""
+        if self._context_dirty:
+            self._context_cache = "[state-snapshot]\n" + "".join(
+                feature.line(feat_id) for feat_id, feature in self.features.items()
+            )
+            self._context_dirty = False
+        return self._context_cache
+
+    def _compact_history(self) -> bool:
+        """
+        Evict the middle of the conversation once it exceeds MAX_HISTORY_MESSAGES.
+
+        The system prompt and the last HISTORY_KEEP_TURNS turns are kept in
+        order so the cached prefix survives. Returns True if history was
+        compacted, in which case the next turn must restate the design.
+        """
+        messages = self.chat.messages
+        if len(messages) <= MAX_HISTORY_MESSAGES or len(self._turn_starts) <= HISTORY_KEEP_TURNS:
+            return False
+
+        start = self._turn_starts[-HISTORY_KEEP_TURNS]
+        recent = list(messages[start:])
+
+        self._init_chat()
+        offset = start - len(self.chat.messages)
+        self._turn_starts = [i - offset for i in self._turn_starts[-HISTORY_KEEP_TURNS:]]
+        for message in recent:
+            self.chat.append(message)
+        return True
+
+    def _begin_turn(self, user_input: str):
+        """Append the user's request as the start of a new turn."""
+        compacted = self._compact_history()
+        self._turn_starts.append(len(self.chat.messages))
+        # Deltas for evicted turns are gone, so restate the whole design once.
+        if compacted and self.features:
+            self.chat.append(user(self._state_snapshot()))
+        self.chat.append(user(user_input))
+
+    def _end_turn(self, response, patches: list[dict]):
+        """Record the model's response and the resulting state change."""
+        if response is not None:
+            self.chat.append(response)
+        # History only ever grows by appending, so the prefix stays cacheable.
+        if patches:
+            self.chat.append(user(f"[state-delta] {orjson.dumps(patches).decode()}"))
+
+    def _embed(self, text: str):
+        """
+        Return a unit-length embedding for text, or None when paraphrase matching is off.
+
+        Matching is off without sentence-transformers, and is switched off for
+        the rest of the session the first time the model fails to load or
+        encode (e.g. offline with no cached weights), so turns never fail on it.
+        """
+        if not self._fuzzy_enabled:
+            return None
+        if text not in self._embeddings:
+            try:
+                self._embeddings[text] = self._get_embedder().encode(text, normalize_embeddings=True)
+            except Exception as e:
+                self._fuzzy_enabled = False
+                print(f"Warning: Semantic cache disabled, embedding model failed: {e}")
+                return None
+        return self._embeddings[text]
+
+    def _get_embedder(self):
+        """Load the sentence-transformer once, even if warm() and a turn race to it."""
+        with self._embedder_lock:
+            if self._embedder is None:
+                self._embedder = SentenceTransformer(EMBEDDING_MODEL)
+        return self._embedder
+
+    async def warm(self):
+        """
+        Prime the provider's prompt cache and the local embedding model.
+
+        Sends a throwaway one-token request that starts with the same system
+        prompt, so the first real turn hits an already-cached prefix, and loads
+        the sentence-transformer on a daemon thread. Warming is best-effort;
+        failures are ignored and the first turn simply pays the cold cost.
+        """
+        ping = self.client.chat.create(model=self.model, max_tokens=1)
+        ping.append(system(CAD_SYSTEM_PROMPT))
+        ping.append(user("Reply with no patches."))
+
+        tasks = [ping.sample()]
+        if self._fuzzy_enabled:
+            tasks.append(_in_daemon_thread(self._embed, "warm up"))
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _lookup_cache(self, user_input: str) -> tuple[list[dict] | None, tuple[int, str]]:
+        """
+        Look up patches previously generated for this input against this state.
+
+        Tries an exact match on the normalized input first, then the closest
+        cached paraphrase by cosine similarity. On a hit the patches are applied
+        and recorded in the chat history as if the model had produced them.
 
-        context = "\n\n[Current Design State]\n"
-        for feat_id, data in self.features.items():
-            context += f"- {feat_id}: {json.dumps(data)}\n"
-        return context
+        Returns:
+            The cached patches (or None on a miss) and the key to store under
+        """
+        key = (self._state_hash, " ".join(user_input.lower().split()))
+        patches = self._exact_cache.get(key)
+
+        if patches is None and self._fuzzy_enabled and key[0] in self._fuzzy_cache:
+            embedding = await _in_daemon_thread(self._embed, key[1])
+            if embedding is not None:
+                matrix, candidates = self._fuzzy_cache[key[0]]
+                scores = np.dot(matrix, embedding)
+                best = int(np.argmax(scores))
+                if scores[best] > SEMANTIC_CACHE_THRESHOLD:
+                    patches = candidates[best]
+
+        if patches is not None:
+            self._begin_turn(user_input)
+            self._apply_patches(patches)
+            self._end_turn(assistant("\n".join(map(self._format_patch, patches))), patches)
+            patches = list(patches)
+
+        return patches, key
+
+    def _store_cache(self, key: tuple[int, str], patches: list[dict]):
+        """Remember the patches generated for a cache key."""
+        if patches:
+            self._exact_cache[key] = list(patches)
+
+    def _store_embedding(self, key: tuple[int, str], patches: list[dict], future: asyncio.Future):
+        """
+        Make the patches findable by paraphrases of the input they were generated for.
 
-    def generate_patches(self, user_input: str) -> list[dict]:
+        Runs as a done-callback of the future embedding the input, so a turn
+        never waits on the embedding model to finish.
+        """
+        if future.cancelled():
+            return
+        embedding = future.result()
+        if patches and embedding is not None:
+            if key[0] in self._fuzzy_cache:
+                matrix, candidates = self._fuzzy_cache[key[0]]
+                matrix = np.vstack([matrix, embedding])
+            else:
+                matrix, candidates = embedding[np.newaxis, :], []
+            candidates.append(list(patches))
+            self._fuzzy_cache[key[0]] = (matrix, candidates)
+
+    @contextmanager
+    def _model_turn(self, user_input: str, cache_key: tuple[int, str]):
+        """
+        Wrap the body of a with block that asks the model for one turn.
+
+        The body stores the model's response and the patches it applied in
+        turn['response'] and turn['patches']. They are recorded in the history
+        even if the body fails or the caller stops iterating early. The cache
+        is only filled when the turn completes.
+        """
+        # Embed the input for the semantic cache while the model is generating
+        embedding = _in_daemon_thread(self._embed, cache_key[1])
+
+        self._begin_turn(user_input)
+        turn = {'response': None, 'patches': []}
+        try:
+            yield turn
+        finally:
+            # History must always describe what reached the design state
+            self._end_turn(turn['response'], turn['patches'])
+        self._store_cache(cache_key, turn['patches'])
+        embedding.add_done_callback(functools.partial(self._store_embedding, cache_key, turn['patches']))
+
+    @staticmethod
+    def _format_patch(patch: dict) -> str:
+        """Render a patch back into its DSL line."""
+        return f"AT {patch['feature_id']} {patch['action']} {orjson.dumps(patch['data']).decode()}"
+
+    async def generate_patches(self, user_input: str) -> list[dict]:
         """
         Convert natural language input to CAD patches.
 
@@ -144,95 +725,235 @@ class CADAgent:
         Returns:
             List of parsed patch dictionaries with keys: feature_id, action, data
         """
-        # Add context about current state
-        context = self._get_context_prompt()
-        full_prompt = user_input + context if context else user_input
+        patches, cache_key = await self._lookup_cache(user_input)
+        if patches is not None:
+            return patches
 
-        self.chat.append(user(full_prompt))
-        response = self.chat.sample()
+        with self._model_turn(user_input, cache_key) as turn:
+            turn['response'] = await self.chat.sample()
+            turn['patches'] = self._parse_patches(turn['response'].content)
+            self._apply_patches(turn['patches'])
 
-        patches = self._parse_patches(response.content)
-        self._apply_patches(patches)
+        return turn['patches']
 
-        return patches
-
-    def _parse_patches(self, response: str) -> list[dict]:
-        """Parse the LLM response into structured patch objects."""
-        patches = []
-        lines = response.strip().split('\n')
+    async def stream_patches(self, user_input: str) -> AsyncIterator[dict]:
+        """
+        Convert natural language input to CAD patches, streaming the response.
 
-        for line in lines:
-            line = line.strip()
-            if not line or not line.startswith('AT '):
-                continue
+        Each patch is parsed and applied as soon as its line is complete, so
+        callers can render the first shape before the model has finished.
 
-            try:
-                # Parse: AT <feature_id> <ACTION> <JSON>
-                parts = line[3:].split(' ', 2)  # Remove "AT " and split
-                if len(parts) < 2:
-                    continue
+        Args:
+            user_input: Natural language description of desired CAD operation
 
-                feature_id = parts[0]
-                action = parts[1].upper()
+        Yields:
+            Parsed patch dictionaries with keys: feature_id, action, data
+        """
+        patches, cache_key = await self._lookup_cache(user_input)
+        if patches is not None:
+            for patch in patches:
+                yield patch
+            return
+
+        with self._model_turn(user_input, cache_key) as turn:
+            parser = PatchStreamParser()
+            applied = turn['patches']
+            async for response, chunk in self.chat.stream():
+                turn['response'] = response
+                for patch in parser.feed(chunk.content):
+                    self._apply_patches([patch])
+                    applied.append(patch)
+                    yield patch
+
+            for patch in parser.close():
+                self._apply_patches([patch])
+                applied.append(patch)
+                yield patch
 
-                if action not in ('INSERT', 'REPLACE', 'DELETE'):
+    def _parse_patches(self, response: str) -> list[dict]:
+        """Parse a complete LLM response into structured patch objects."""
+        patches = []
+        for line in response.split('\n'):
+            # Most non-patch lines (blank, fences, prose) fail this without a copy
+            if not line.startswith('AT '):
+                if not line[:1].isspace():
+                    continue
+                line = line.lstrip()
+                if not line.startswith('AT '):
                     continue
 
-                # Parse JSON content
-                json_str = parts[2] if len(parts) > 2 else '{}'
-                data = json.loads(json_str)
+            patch = self._handle_line(line)
+            if patch:
+                patches.append(patch)
+        return patches
 
-                patches.append({
-                    'feature_id': feature_id,
-                    'action': action,
-                    'data': data
-                })
+    def _handle_line(self, line: str) -> dict | None:
+        """Parse a line starting with "AT " into a patch, or None if it is not one."""
+        match = _PATCH_RE.match(line.rstrip())
+        if not match:
+            return None
 
-            except (json.JSONDecodeError, IndexError) as e:
-                print(f"Warning: Failed to parse patch line: {line}")
-                continue
-
-        return patches
+        feature_id, action, json_str = match.groups()
+        # Interned so the features dict and every cached patch share one string per id
+        feature_id = sys.intern(feature_id)
+        try:
+            data = orjson.loads(json_str or '{}')
+        except orjson.JSONDecodeError:
+            print(f"Warning: Failed to parse patch line: {line}")
+            return None
+
+        patch = {
+            'feature_id': feature_id,
+            'action': action,
+            'data': data
+        }
+        return patch if _validate_patch(patch) else None
 
     def _apply_patches(self, patches: list[dict]):
         """Apply patches to internal feature state."""
+        # Reduce the batch to its net effect, then update the feature dict once.
+        # Ids deleted and re-inserted are popped first so they move to the end,
+        # matching patch-by-patch application.
+        upserts = {}
+        deletes = set()
+        counter = self.feature_counter
         for patch in patches:
             feat_id = patch['feature_id']
             action = patch['action']
-            data = patch['data']
-
-            if action == 'INSERT':
-                self.features[feat_id] = data
-                # Update counter if needed
-                if feat_id.startswith('feat_'):
-                    try:
-                        num = int(feat_id.split('_')[1])
-                        self.feature_counter = max(self.feature_counter, num)
-                    except ValueError:
-                        pass
 
-            elif action == 'REPLACE':
-                self.features[feat_id] = data
+            if action == 'DELETE':
+                upserts.pop(feat_id, None)
+                deletes.add(feat_id)
+                continue
 
-            elif action == 'DELETE':
-                self.features.pop(feat_id, None)
+            data = patch['data']
+            upserts[feat_id] = _FEATURE_CLASSES[data['type']](feat_id, data)
+
+            # Update counter if needed
+            if action == 'INSERT' and feat_id.startswith('feat_'):
+                suffix = feat_id[5:]
+                # isdecimal() (unlike isdigit()) accepts only what int() can parse
+                if suffix.isdecimal():
+                    num = int(suffix)
+                    if num > counter:
+                        counter = num
+
+        self.feature_counter = counter
+
+        # The state hash is an XOR over features, so each change is O(1):
+        # xor out the hash of whatever is removed or replaced, xor in the new one.
+        state_hash = self._state_hash
+        for feat_id in deletes:
+            old = self.features.pop(feat_id, None)
+            if old is not None:
+                state_hash ^= old.hash
+                self._context_dirty = True
+
+        if upserts:
+            current = self.features
+            for feat_id, feature in upserts.items():
+                old = current.get(feat_id)
+                if old is None:
+                    self._context_dirty = True
+                else:
+                    state_hash ^= old.hash
+                    if old.hash != feature.hash:
+                        self._context_dirty = True
+                state_hash ^= feature.hash
+            # dict.update() sizes the table for the whole batch up front
+            self.features.update(upserts)
+
+        self._state_hash = state_hash
 
     def get_current_state(self) -> dict:
         """Return the current design state."""
-        return self.features.copy()
+        return {feat_id: feature.to_dict() for feat_id, feature in self.features.items()}
 
     def export_patches_json(self, patches: list[dict]) -> str:
         """Export patches as JSON string for frontend consumption."""
-        return json.dumps(patches, indent=2)
+        return orjson.dumps(patches, option=orjson.OPT_INDENT_2).decode()
+
+    def export_patches_ndjson(self, patches: list[dict]) -> bytes:
+        """Export patches as NDJSON (one object per line) so consumers can parse them incrementally."""
+        return b"".join(orjson.dumps(patch, option=orjson.OPT_APPEND_NEWLINE) for patch in patches)
+
+    def write_patches_ndjson(self, fd: int, patches: list[dict]) -> int:
+        """Write patches as NDJSON to a file descriptor, coalesced into one writev() call."""
+        chunks = [orjson.dumps(patch, option=orjson.OPT_APPEND_NEWLINE) for patch in patches]
+        # writev() rejects more than IOV_MAX buffers with EINVAL
+        iov_max = os.sysconf('SC_IOV_MAX')
+        total = 0
+        for i in range(0, len(chunks), iov_max):
+            batch = chunks[i:i + iov_max]
+            size = sum(map(len, batch))
+            written = os.writev(fd, batch)
+
+            # Pipes and sockets may accept only part of the batch
+            if written < size:
+                rest = memoryview(b"".join(batch))[written:]
+                while rest:
+                    rest = rest[os.write(fd, rest):]
+            total += size
+        return total
 
     def reset(self):
         """Reset the agent state and start fresh."""
         self.features = {}
+        self._context_cache = None
+        self._context_dirty = True
+        self._state_hash = 0
         self.feature_counter = 0
-        self._init_chat()
 
+        # Keep the session so the provider's cached prefix is reused; the
+        # marker tells the model to disregard the earlier design.
+        self._turn_starts.append(len(self.chat.messages))
+        self.chat.append(user("[SESSION RESET — ignore prior design, start fresh]"))
+
+
+def _setup_readline():
+    """Enable line editing and persistent history for the CLI prompt, if available."""
+    try:
+        import readline
+    except ImportError:  # Not available on Windows
+        return
+
+    try:
+        readline.read_history_file(HISTORY_FILE)
+    except OSError:  # No history saved yet
+        pass
+    readline.set_history_length(1000)
 
-def main():
+    def save():
+        try:
+            readline.write_history_file(HISTORY_FILE)
+        except OSError:
+            pass
+
+    atexit.register(save)
+
+    # input() runs on a daemon thread (see _ainput), so Ctrl+C can end the
+    # process while readline still has the tty in raw mode; put it back.
+    import termios
+    if not sys.stdin.isatty():
+        return
+    fd = sys.stdin.fileno()
+    saved = termios.tcgetattr(fd)
+
+    def restore():
+        try:
+            termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+        except termios.error:
+            pass
+
+    atexit.register(restore)
+
+
+async def _ainput(prompt: str) -> str:
+    """Read a line from stdin without blocking the event loop."""
+    return await _in_daemon_thread(input, prompt)
+
+
+async def main():
     """Interactive CLI for the CAD agent."""
     print("=" * 60)
     print("CAD Agent - Natural Language to CAD DSL")
@@ -242,54 +963,65 @@ def main():
     print("=" * 60)
     print()
 
+    _setup_readline()
     agent = CADAgent()
+    # Warm up while the user reads the banner and types the first request
+    warmup = asyncio.create_task(agent.warm())
 
-    while True:
-        try:
-            user_input = input("You: ").strip()
-        except (KeyboardInterrupt, EOFError):
-            print("\nGoodbye!")
-            break
-
-        if not user_input:
-            continue
-
-        if user_input.lower() in ('quit', 'exit', 'bye'):
-            print("Goodbye!")
-            break
-
-        if user_input.lower() == 'state':
-            state = agent.get_current_state()
-            if state:
-                print("\n[Current Design State]")
-                print(json.dumps(state, indent=2))
-            else:
-                print("\n[No features in current design]")
-            print()
-            continue
+    try:
+        while True:
+            try:
+                user_input = (await _ainput("You: ")).strip()
+            except (KeyboardInterrupt, EOFError):
+                print("\nGoodbye!")
+                break
 
-        if user_input.lower() == 'reset':
-            agent.reset()
-            print("[Design reset - starting fresh]\n")
-            continue
+            if not user_input:
+                continue
 
-        try:
-            patches = agent.generate_patches(user_input)
+            if user_input.lower() in ('quit', 'exit', 'bye'):
+                print("Goodbye!")
+                break
+
+            if user_input.lower() == 'state':
+                state = agent.get_current_state()
+                if state:
+                    print("\n[Current Design State]")
+                    print(json.dumps(state, indent=2))
+                else:
+                    print("\n[No features in current design]")
+                print()
+                continue
 
-            if patches:
-                print("\n[Generated Patches]")
-                for patch in patches:
+            if user_input.lower() == 'reset':
+                agent.reset()
+                print("[Design reset - starting fresh]\n")
+                continue
+
+            try:
+                patches = []
+                async for patch in agent.stream_patches(user_input):
+                    if not patches:
+                        print("\n[Generated Patches]")
+                    patches.append(patch)
                     action = patch['action']
                     feat_id = patch['feature_id']
                     data = json.dumps(patch['data'])
-                    print(f"AT {feat_id} {action} {data}")
-                print()
-            else:
-                print("\n[No valid patches generated]\n")
+                    print(f"AT {feat_id} {action} {data}", flush=True)
+
+                if patches:
+                    print()
+                else:
+                    print("\n[No valid patches generated]\n")
 
-        except Exception as e:
-            print(f"\n[Error: {e}]\n")
+            except Exception as e:
+                print(f"\n[Error: {e}]\n")
+    finally:
+        warmup.cancel()
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\nGoodbye!")